@@ -15,6 +15,10 @@ Features:
   - Enable haptic alert
   - Blink yellow LED every second
 
+- Alert state hysteresis
+  - Lower RSSI threshold to enable the alert, higher one to disable it
+  - Threshold has to be crossed for several samples in a row
+
 - Action button short press
   - Turn the device on
   - Toggle vibration but don't disable alert state
@@ -23,15 +27,12 @@ Features:
 - Turn the device off on action button long press
 
 - Low battery alert
-  - Threshold for low battery currently 3.6 V
+  - Threshold for low battery currently 3.55 V, cleared above 3.7 V
+  - Voltage is checked every 5s
   - Blink red LED instead of blue every 4-5s when voltage too low
 
 TODO:
 
-- Implement lower and upper thresholds for RSSI/distance
-  - ATM alerts are too sensitive near the single threshold
-  - use lower one when alert is on and higher one when it is off
-
 - Calculate distance instead of just measuring RSSI
   - Distance == 10^((Measured power – RSSI)/(10 * N))
     - Measured power == 1m RSSI of the BLE chip
@@ -46,13 +47,18 @@ TODO:
 
 import time
 import os
+import asyncio
 import gc
 import binascii
+import math
 
 # pylint: disable=import-error
+import _bleio
+from micropython import const
 import board
 import microcontroller
 import alarm
+import supervisor
 import busio
 from digitalio import DigitalInOut, Direction, Pull
 from analogio import AnalogIn
@@ -65,46 +71,73 @@ from adafruit_ble.services.nordic import UARTService
 # Haptic effects
 # Refer to table 11.2 in the datasheet:
 # http://www.ti.com/lit/ds/symlink/drv2605.pdf
-HAPTIC_EFFECT_NOTIFY = 47
-HAPTIC_EFFECT_NOTIFY_LEVEL = 80
-HAPTIC_EFFECT_ALERT = 58
-HAPTIC_EFFECT_ALERT_LEVEL = 100
-HAPTIC_EFFECT_ALERT_SECONDS = 1
+HAPTIC_EFFECT_NOTIFY = const(47)
+HAPTIC_EFFECT_NOTIFY_LEVEL = const(80)
+HAPTIC_EFFECT_ALERT = const(58)
+HAPTIC_EFFECT_ALERT_LEVEL = const(100)
+HAPTIC_EFFECT_ALERT_SECONDS = const(1)
+
+# Haptic driver registers, refer to the register map in the datasheet
+DRV2605_REG_WAVESEQ1 = const(0x04)
+DRV2605_REG_GO = const(0x0C)
 
 BTN = board.D6
-BTN_LONG_PRESS_SECONDS = 8
-
-COLOR_OFF = "off"
-COLOR_BLUE = "blue"
-COLOR_GREEN = "green"
-COLOR_CYAN = "cyan"
-COLOR_PURPLE = "purple"
-COLOR_RED = "red"
-COLOR_YELLOW = "yellow"
-COLORS = {
-    COLOR_OFF: (0, 0, 0),
-    COLOR_BLUE: (0, 0, 255),
-    COLOR_GREEN: (0, 255, 0),
-    COLOR_CYAN: (0, 255, 255),
-    COLOR_PURPLE: (180, 0, 255),
-    COLOR_RED: (255, 0, 0),
-    COLOR_YELLOW: (255, 150, 0),
-}
+BTN_LONG_PRESS_SECONDS = const(8)
+
+COLOR_OFF = (0, 0, 0)
+COLOR_BLUE = (0, 0, 255)
+COLOR_GREEN = (0, 255, 0)
+COLOR_CYAN = (0, 255, 255)
+COLOR_PURPLE = (180, 0, 255)
+COLOR_RED = (255, 0, 0)
+COLOR_YELLOW = (255, 150, 0)
 
 BLE_MAC_CENTRAL = "f4:a7:b4:0b:c7:36"
 BLE_MAC_PERIPHERAL = "e2:6d:58:bd:ec:4b"
-BLE_RSSI_THRESHOLD = -80
-LOW_BATTERY_THRESHOLD = 3.6
-MEASURED_POWER = -58
-ENVIRONMENTAL_FACTOR = 3
-
-LED_STATUS_SECONDS = 5
+# Address bytes are stored in reverse order
+BLE_ADDR_CENTRAL = bytes(
+    reversed(binascii.unhexlify(BLE_MAC_CENTRAL.replace(":", "")))
+)
+BLE_ADDR_PERIPHERAL = bytes(
+    reversed(binascii.unhexlify(BLE_MAC_PERIPHERAL.replace(":", "")))
+)
+BLE_RSSI_ENTER = const(-80)
+BLE_RSSI_EXIT = const(-74)
+BLE_RSSI_MIN_SAMPLES = const(3)
+# Alert state sent to the peripheral, indexed by the state
+BLE_ALERT_STATE_PAYLOAD = (b"0", b"1")
+BLE_SCAN_SECONDS = 0.3
+BLE_SCAN_BUFFER_SIZE = const(128)
+# Keep scanning far away devices, their RSSI is needed to trigger alerts
+BLE_SCAN_MINIMUM_RSSI = const(-100)
+# Weight of older RSSI samples, ~10 samples effective window
+BLE_RSSI_DECAY = 0.9
+LOW_BATTERY_THRESHOLD = 3.55
+LOW_BATTERY_CLEAR_THRESHOLD = 3.7
+SENSOR_SAMPLE_SECONDS = const(5)
+# Raw ADC value to LiPo voltage, 3.6V reference and 1/2 voltage divider
+LIPO_VOLTAGE_SCALE = 3.6 / 65536 * 2
+MEASURED_POWER = const(-58)
+ENVIRONMENTAL_FACTOR = const(3)
+# 10^(x/(10 * N)) == e^(x * ln(10)/(10 * N))
+DISTANCE_FACTOR = math.log(10) / (10 * ENVIRONMENTAL_FACTOR)
+
+LED_STATUS_SECONDS = const(5)
+BLE_CONNECTION_CHECK_SECONDS = 0.5
+
+# How often polling tasks yield to the scheduler
+TASK_POLL_SECONDS = 0.01
 
 # Initialize I2C bus
 # pylint: disable=invalid-name
 i2c = busio.I2C(board.SCL, board.SDA)
 # Initialize haptic driver
 drv = adafruit_drv2605.DRV2605(i2c)
+# Waveform sequencer slots 1-8 and GO register, written in a single
+# auto-incremented transaction. Empty slots terminate the sequence.
+haptic_buffer = bytearray(DRV2605_REG_GO - DRV2605_REG_WAVESEQ1 + 2)
+haptic_buffer[0] = DRV2605_REG_WAVESEQ1
+haptic_buffer[-1] = 1
 # Initialize ble mode input
 d5 = DigitalInOut(board.D5)
 d5.direction = Direction.INPUT
@@ -119,64 +152,163 @@ lipo_voltage_raw = AnalogIn(board.VOLTAGE_MONITOR)
 pixels = neopixel.NeoPixel(board.NEOPIXEL, 1)
 # Initialize ble
 ble = BLERadio()
+# Own address never changes
+ble_addr_bytes = bytes(ble._adapter.address.address_bytes)
 
 ble_is_central = d5.value
-ble_rssi = []
+# Exponentially decaying RSSI sample count, sum and sum of squares
+ble_rssi_n = 0
+ble_rssi_s = 0
+ble_rssi_q = 0
 mean_rssi = 0
+rssi_cross_count = 0
 btn_state = btn.value
 btn_timestamp = 0
 alert_state = False
 alert_timestamp = 0
 silent = False
 status_timestamp = time.monotonic()
+connection_timestamp = 0
+battery_low = False
+lipo_voltage = 0.0
+cpu_temperature = 0.0
+blink_color = COLOR_OFF
+blink_duration = 0
+blink_toggles = 0
+blink_timestamp = 0
+shutting_down = False
 
 if not ble_is_central:
     uart = UARTService()
     advertisement = ProvideServicesAdvertisement(uart)
 
 
+def log(msg, *args):
+    """Print a message if USB serial is connected.
+
+    Message is formatted with given arguments only when it is printed.
+    """
+    if supervisor.runtime.serial_connected:
+        print(msg.format(*args) if args else msg)
+
+
 def vibrate(effect=HAPTIC_EFFECT_NOTIFY, level=HAPTIC_EFFECT_NOTIFY_LEVEL):
     """Play a given haptic effect at a given level.
 
     Possible levels: 20, 40, 60, 80 and 100%.
     """
     effect = int(HAPTIC_EFFECT_ALERT + 5 - level / 20)
-    drv.sequence[0] = adafruit_drv2605.Effect(effect)
+    haptic_buffer[1] = effect
 
-    print(f"Playing haptic effect {effect} at {level}%...")
+    log("Playing haptic effect {} at {}%...", effect, level)
 
-    drv.play()
+    with drv._device as device:
+        device.write(haptic_buffer)
+
+
+def sample_sensors():
+    """Read LiPo voltage and CPU temperature, update low battery state."""
+    global lipo_voltage, cpu_temperature, battery_low
+
+    lipo_voltage = lipo_voltage_raw.value * LIPO_VOLTAGE_SCALE
+    cpu_temperature = microcontroller.cpu.temperature
+
+    if battery_low:
+        battery_low = lipo_voltage < LOW_BATTERY_CLEAR_THRESHOLD
+    else:
+        battery_low = lipo_voltage < LOW_BATTERY_THRESHOLD
 
 
 def low_battery():
-    is_low_battery = False
-    lipo_voltage = (lipo_voltage_raw.value * 3.6) / 65536 * 2
-    if lipo_voltage < LOW_BATTERY_THRESHOLD:
-        is_low_battery = True
-    return is_low_battery
+    return battery_low
 
 
 def blink(color, duration=0.5, count=1):
-    """Flash neopixel led.
+    """Start flashing neopixel led.
 
-    Duration in seconds for a single blink.
+    Color is an RGB tuple, duration in seconds for a single blink. The
+    led is toggled by update_blink() from the blink task.
     """
-    for i in range(count):
-        pixels[0] = COLORS[color]
-        time.sleep(duration)
-        pixels[0] = COLORS[COLOR_OFF]
+    global blink_color, blink_duration, blink_toggles, blink_timestamp
+
+    blink_color = color
+    blink_duration = duration
+    # Every blink turns the led on and off
+    blink_toggles = count * 2
+    blink_timestamp = time.monotonic()
 
-        # Don't wait after the last loop
-        if i != count - 1:
-            time.sleep(duration)
+    update_blink(blink_timestamp)
+
+
+def update_blink(timestamp):
+    """Toggle neopixel led when the current blink phase is over."""
+    global blink_toggles, blink_timestamp
+
+    if not blink_toggles or timestamp < blink_timestamp:
+        return
+
+    blink_toggles -= 1
+    pixels[0] = blink_color if blink_toggles % 2 else COLOR_OFF
+    blink_timestamp = timestamp + blink_duration
 
 
 def bytes_to_mac(addr_bytes):
     """Convert address bytes to MAC."""
-    return ":".join(f"{b:02x}" for b in reversed(addr_bytes))
+    return binascii.hexlify(bytes(reversed(addr_bytes)), ":").decode("utf8")
+
+
+def revert_state():
+    """Undo the last alert state change and forget collected RSSI samples.
+
+    Used when the peripheral could not be informed about the change, so
+    that it is retried on the next scans.
+    """
+    global ble_rssi_n, ble_rssi_s, ble_rssi_q, mean_rssi
+    global rssi_cross_count, alert_state
+
+    alert_state = not alert_state
+
+    ble_rssi_n = 0
+    ble_rssi_s = 0
+    ble_rssi_q = 0
+    mean_rssi = 0
+    rssi_cross_count = 0
+
+
+def update_state(rssi):
+    """Add a new RSSI sample and update the alert state.
+
+    Returns True when the alert state has changed.
+    """
+    global ble_rssi_n, ble_rssi_s, ble_rssi_q, mean_rssi
+    global rssi_cross_count, alert_state
+
+    ble_rssi_n = ble_rssi_n * BLE_RSSI_DECAY + 1
+    ble_rssi_s = ble_rssi_s * BLE_RSSI_DECAY + rssi
+    ble_rssi_q = ble_rssi_q * BLE_RSSI_DECAY + rssi * rssi
+    mean_rssi = ble_rssi_s / ble_rssi_n
+
+    if alert_state:
+        # Our peripheral device is back!
+        crossed = mean_rssi > BLE_RSSI_EXIT
+    else:
+        # Our peripheral device is too far away!
+        crossed = mean_rssi < BLE_RSSI_ENTER
 
+    if not crossed:
+        rssi_cross_count = 0
+        return False
 
-def connect():
+    rssi_cross_count += 1
+    if rssi_cross_count < BLE_RSSI_MIN_SAMPLES:
+        return False
+
+    rssi_cross_count = 0
+    alert_state = not alert_state
+    return True
+
+
+async def connect():
     """Try to connect to a peripheral device.
 
     We only connect to a device when it is too far away or has just
@@ -185,87 +317,89 @@ def connect():
     """
     # print(f"Connecting...")
 
-    global ble_rssi, alert_state, mean_rssi
     connection = None
 
     for adv in ble.start_scan(
-        ProvideServicesAdvertisement, timeout=1, minimum_rssi=-100
+        ProvideServicesAdvertisement,
+        buffer_size=BLE_SCAN_BUFFER_SIZE,
+        timeout=BLE_SCAN_SECONDS,
+        minimum_rssi=BLE_SCAN_MINIMUM_RSSI,
+        active=False,
     ):
-        if UARTService not in adv.services:
-            continue
+        # Scanning blocks, let other tasks run between advertisements
+        await asyncio.sleep(0)
 
-        addr = bytes_to_mac(adv.address.address_bytes)
-        if addr != BLE_MAC_PERIPHERAL:
+        # Compare raw address bytes, cheaper than formatting a MAC
+        if adv.address.address_bytes != BLE_ADDR_PERIPHERAL:
             continue
-        time.sleep(0.2)
+        await asyncio.sleep(0.2)
 
-        ble_rssi.append(adv.rssi)
-        if len(ble_rssi) > 10:
-            ble_rssi.pop(0)
+        # Connect only to trigger or dismiss an alert
+        if not update_state(adv.rssi):
+            continue
 
-        mean_rssi = 0
-        for i in ble_rssi:
-            mean_rssi = mean_rssi + i
-        mean_rssi = mean_rssi / len(ble_rssi)
-
-        # Our peripheral device is too far away!
-        if mean_rssi and mean_rssi < BLE_RSSI_THRESHOLD:
-            # Alert was not in effect
-            if not alert_state:
-                alert_state = True
-                connection = ble.connect(adv)
-                print(f"Connected to {addr}")
-                break
-        # Our peripheral device is back!
-        else:
-            # We need to infor the device that alert is over
-            if alert_state:
-                alert_state = False
-                try:
-                    connection = ble.connect(adv)
-                    print(f"Connected to {addr}")
-                except:
-                    print("Connection failed")
-                    ble_rssi = []
-                break
+        try:
+            connection = ble.connect(adv)
+        except (OSError, _bleio.BluetoothError):
+            log("Connection failed")
+            revert_state()
+        break
 
     ble.stop_scan()
 
     if not connection:
         return
 
+    if not connection.connected:
+        log("Connection lost")
+        revert_state()
+        return
+
+    log("Connected to {}", BLE_MAC_PERIPHERAL)
+
     # Send own MAC address and alert state
     try:
-        uart = connection[UARTService]  # pylint: disable=redefined-outer-name
-        uart.write(ble._adapter.address.address_bytes)
-        time.sleep(0.2)
-        print(f"Sending alert state: {alert_state}")
-        uart.write(str(int(alert_state)).encode("utf-8"))
-    except:
-        print("Connection failed!")
-        ble_rssi = []
-    finally:
+        # Services are checked only once connected to our peripheral
+        if UARTService in connection:
+            peripheral_uart = connection[UARTService]
+            peripheral_uart.write(ble_addr_bytes)
+            await asyncio.sleep(0.2)
+            log("Sending alert state: {}", alert_state)
+            peripheral_uart.write(BLE_ALERT_STATE_PAYLOAD[alert_state])
+        else:
+            log("UART service missing")
+            revert_state()
+    except (OSError, _bleio.BluetoothError):
+        log("Connection failed!")
+        revert_state()
+
+    if connection.connected:
         connection.disconnect()
 
 
 def wait_for_connection():
-    """Wait for a connection from a central device."""
-    global alert_state
+    """Wait for a connection from a central device.
+
+    Returns immediately until the next connection check is due.
+    """
+    global alert_state, connection_timestamp
+
+    now = time.monotonic()
+    if now < connection_timestamp + BLE_CONNECTION_CHECK_SECONDS:
+        return
+    connection_timestamp = now
 
     if not ble._adapter.advertising:
-        print("Connecting...")
+        log("Connecting...")
 
         ble.start_advertising(advertisement)
 
     if not ble.connected:
-        time.sleep(0.5)
         return
 
     # Receive MAC address of the central
-    addr = bytes_to_mac(uart.read(6))
-
-    if addr == BLE_MAC_CENTRAL:
-        print(f"Connected to {addr}")
+    if uart.read(6) == BLE_ADDR_CENTRAL:
+        log("Connected to {}", BLE_MAC_CENTRAL)
 
         data = uart.readline().decode("utf8").strip()
 
@@ -273,7 +407,7 @@ def wait_for_connection():
             # Receive state
             alert_state = bool(int(data))
 
-            print(f"Received alert state: {alert_state}")
+            log("Received alert state: {}", alert_state)
 
     # ble.stop_advertising()
 
@@ -283,7 +417,7 @@ def reboot():
 
     Equivalent to pressing the reset button.
     """
-    print("Rebooting...")
+    log("Rebooting...")
 
     microcontroller.reset()
 
@@ -293,7 +427,7 @@ def shutdown():
 
     Will wake up when action button is pressed.
     """
-    print("Shutting down...")
+    log("Shutting down...")
 
     # Release the BTN pin
     btn.deinit()
@@ -302,79 +436,144 @@ def shutdown():
     )
 
 
+def rssi_deviation():
+    if ble_rssi_n > 1:
+        variance = (ble_rssi_q - ble_rssi_s * ble_rssi_s / ble_rssi_n) / (
+            ble_rssi_n - 1
+        )
+        return f"{math.sqrt(max(variance, 0)):.1f}"
+    return "N/A"
+
+
 def distance():
     if mean_rssi:
-        dist = 10 ** (
-            (MEASURED_POWER - mean_rssi) / (10 * ENVIRONMENTAL_FACTOR)
-        )
+        dist = math.exp((MEASURED_POWER - mean_rssi) * DISTANCE_FACTOR)
         return dist
     return "N/A"
 
 
 def print_info():
+    # Skip formatting when nobody is listening
+    if not supervisor.runtime.serial_connected:
+        return
+
     print("\nLapsipaimen\n===========")
 
     serial = binascii.hexlify(microcontroller.cpu.uid).decode("utf8")
-    lipo_voltage = (lipo_voltage_raw.value * 3.6) / 65536 * 2
 
     print(f"State: {'ALARMING' if alert_state else 'NORMAL'}")
     print(f"Silent: {silent}")
     print(f"Serial number: {serial}")
-    print(f"Temperature: {microcontroller.cpu.temperature:.1f}C")
+    print(f"Temperature: {cpu_temperature:.1f}C")
     print(f"Free RAM: {gc.mem_free()/1024:.1f}KB")  # pylint: disable=no-member
     print(f"BLE mode: {'Central' if ble_is_central else 'Peripheral'}")
-    print(f"BLE address: {bytes_to_mac(ble._adapter.address.address_bytes)}")
-    print(f"BLE signal strength: {ble_rssi if ble_rssi else 'N/A'}")
+    print(f"BLE address: {ble_addr}")
+    print(f"BLE signal strength: {mean_rssi if mean_rssi else 'N/A'}")
+    print(f"BLE signal deviation: {rssi_deviation()}")
     print(f"Approximate distance: {distance()}")
-    print(f"BLE signal threshold: {BLE_RSSI_THRESHOLD}")
+    print(f"BLE signal thresholds: {BLE_RSSI_ENTER}/{BLE_RSSI_EXIT}")
     print(f"LiPo voltage: {lipo_voltage:.2f}V")
     print(f"Powered by {os.uname().machine}\n")
 
 
-print("Starting software...")
-print_info()
-vibrate()
-blink(COLOR_CYAN)
+async def poll_button():
+    """Toggle silence on button press, shutdown on long press."""
+    global btn_state, btn_timestamp, silent, shutting_down
 
-while True:
-    now = time.monotonic()
-    btn_state_new = btn.value
+    while True:
+        now = time.monotonic()
+        btn_state_new = btn.value
+
+        # Button pressed, toggle silence and show info
+        if btn_state != btn_state_new and not btn_state_new:
+            btn_timestamp = now
+            silent = not silent
+
+            log("Button pressed")
+            print_info()
+
+        # Button long-pressed, shutdown once the led has finished blinking
+        if not btn_state_new and now > btn_timestamp + BTN_LONG_PRESS_SECONDS:
+            shutting_down = True
 
-    # Button pressed, toggle silence and show info
-    if btn_state != btn_state_new and not btn_state_new:
-        btn_timestamp = now
-        silent = not silent
+            log("Button long-pressed")
+            blink(COLOR_PURPLE, 0.1, 5)
 
-        print("Button pressed")
-        print_info()
+            while blink_toggles:
+                await asyncio.sleep(TASK_POLL_SECONDS)
+            shutdown()
 
-    # Button long-pressed, reboot
-    if not btn_state_new and now > btn_timestamp + BTN_LONG_PRESS_SECONDS:
-        print("Button long-pressed")
-        blink(COLOR_PURPLE, 0.1, 5)
-        shutdown()
+        btn_state = btn_state_new
 
-    btn_state = btn_state_new
+        await asyncio.sleep(TASK_POLL_SECONDS)
 
-    # Play the next loop of alert effect if needed
-    if alert_state and now > alert_timestamp + HAPTIC_EFFECT_ALERT_SECONDS:
-        alert_timestamp = now
 
-        blink(COLOR_YELLOW, 0.25)
+async def blink_task():
+    """Drive neopixel led blinking."""
+    while True:
+        update_blink(time.monotonic())
 
-        if not silent:
-            vibrate(HAPTIC_EFFECT_ALERT, HAPTIC_EFFECT_ALERT_LEVEL)
-    # Blink status led otherwise
-    elif not alert_state and now > status_timestamp + LED_STATUS_SECONDS:
-        status_timestamp = now
+        await asyncio.sleep(TASK_POLL_SECONDS)
 
-        if low_battery():
-            blink(COLOR_RED, 0.25)
+
+async def alert_task():
+    """Play haptic alert or blink status led."""
+    global alert_timestamp, status_timestamp
+
+    while not shutting_down:
+        now = time.monotonic()
+
+        # Play the next loop of alert effect if needed
+        if alert_state and now > alert_timestamp + HAPTIC_EFFECT_ALERT_SECONDS:
+            alert_timestamp = now
+
+            blink(COLOR_YELLOW, 0.25)
+
+            if not silent:
+                vibrate(HAPTIC_EFFECT_ALERT, HAPTIC_EFFECT_ALERT_LEVEL)
+        # Blink status led otherwise
+        elif not alert_state and now > status_timestamp + LED_STATUS_SECONDS:
+            status_timestamp = now
+
+            if low_battery():
+                blink(COLOR_RED, 0.25)
+            else:
+                blink(COLOR_BLUE, 0.25)
+
+        await asyncio.sleep(TASK_POLL_SECONDS)
+
+
+async def sensor_task():
+    """Sample sensors periodically, first sample is taken at startup."""
+    while True:
+        await asyncio.sleep(SENSOR_SAMPLE_SECONDS)
+
+        sample_sensors()
+
+
+async def ble_task():
+    """Try to connect or wait for connection."""
+    while not shutting_down:
+        if ble_is_central:
+            await connect()
         else:
-            blink(COLOR_BLUE, 0.25)
+            wait_for_connection()
 
-    # Try to connect or wait for connection
-    if ble_is_central:
-        connect()
-    else:
-        wait_for_connection()
+        await asyncio.sleep(TASK_POLL_SECONDS)
+
+
+async def main():
+    await asyncio.gather(
+        poll_button(), blink_task(), alert_task(), sensor_task(), ble_task()
+    )
+
+
+ble_addr = bytes_to_mac(ble_addr_bytes)
+
+log("Starting software...")
+sample_sensors()
+print_info()
+vibrate()
+blink(COLOR_CYAN)
+
+asyncio.run(main())